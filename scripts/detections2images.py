@@ -14,12 +14,19 @@ __email__  = 'novakli2@fel.cvut.cz'
 
 
 import argparse
+import itertools
+import multiprocessing
 import os
 import cv2
+import numpy as np
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
 import matplotlib.patches as patches
+from matplotlib.collections import LineCollection
 
 import matplotlib
 matplotlib.use('Agg')  # Prevents from using X interface for plotting
+matplotlib.rcParams['pdf.compression'] = 0  # Faster writing of the xz plots to PDF
 from matplotlib import pyplot as plt
 
 from data.shared.bb3txt import load_bb3txt
@@ -38,23 +45,69 @@ COLORS = {
 	'person': '#FF33CC',
 }
 
+# Edges of the 3D bounding box - pairs of corner indices (FBL FBR RBR RBL FTL FTR RTR RTL)
+FRONT_IDX = np.array([[4,5], [5,1], [1,0], [0,4]])
+REAR_IDX  = np.array([[2,3], [3,7], [7,6], [6,2]])
+CONN_IDX  = np.array([[4,7], [5,6], [1,2], [0,3]])
+# All 12 edges - front side (0:4), rear side (4:8) and connections (8:12)
+EDGES_IDX = np.vstack((FRONT_IDX, REAR_IDX, CONN_IDX))
+# Edges of the bounding box base on the xz plane (front, left, right, rear)
+XZ_IDX    = np.array([[0,1], [0,3], [1,2], [2,3]])
+
+# Factors, by which the images can be downscaled when reading them (see get_imread_flag())
+SCALES = [1, 2, 4, 8]
+
+# Margin around the bounding boxes when cropping the output images to them (in pixels)
+CROP_MARGIN = 20
+
+# Description of one frame to be rendered - sent to the rendering workers:
+#   i:           Index of the frame in the sequence
+#   filename:    Path to the image (as in the BBTXT or BB3TXT file)
+#   bbs:         List of BB2D or BB3D objects to be displayed in the image
+#   pgp:         PGP object of the image or None if 2D bounding boxes are to be plotted
+#   corners:     Corners of the 3D bounding boxes (see _plot_bboxes()) or None if not computed yet
+#   colors_hex:  Dictionary of hex colors of the bounding boxes indexed by labels
+#   colors_bgr:  Dictionary of BGR colors of the bounding boxes indexed by labels
+#   path_datasets, path_out, xz_format, scale, crop_to_bbs: See ImageGenerator
+FrameTask = namedtuple('FrameTask', ['i', 'filename', 'bbs', 'pgp', 'corners', 'colors_hex', 
+									 'colors_bgr', 'path_datasets', 'path_out', 'xz_format', 
+									 'scale', 'crop_to_bbs'])
+
 # Initialize the LabelMappingManager
 LMM = LabelMappingManager()
 
+# Figure with the xz plane plot and its static artists - created once in each process
+_xz_plot = None
+
 
 ####################################################################################################
 #                                            FUNCTIONS                                             # 
 ####################################################################################################
 
-def ri(x):
-	return int(round(x))
-
-
 def hex2bgr(hex):
 	hex = hex.strip('#')
 	return (int(hex[4:6], 16), int(hex[2:4], 16), int(hex[0:2], 16))
 
 
+# BGR colors of the categories - there is only a handful of them so we convert them just once
+HEX2BGR = {color: hex2bgr(color) for color in COLORS.values()}
+
+
+def get_imread_flag(scale):
+	"""
+	Returns the cv2.imread flag for reading an image downscaled by the given factor - JPEG images
+	are decoded directly in the reduced resolution. The reduced flags are only in OpenCV >= 3.2.
+
+	Input:
+		scale: Downscaling factor, one of SCALES
+	Returns:
+		cv2.imread flag or None if this OpenCV version cannot read reduced images
+	"""
+	if scale == 1:
+		return cv2.IMREAD_COLOR
+	return getattr(cv2, 'IMREAD_REDUCED_COLOR_%d'%(scale), None)
+
+
 def get_path_to_image(path_image, path_datasets=None):
 	"""
 	If path_datasets is not none it replaces the path in the image path with this one.
@@ -69,6 +122,230 @@ def get_path_to_image(path_image, path_datasets=None):
 		return path_image
 
 
+def _get_xz_plot():
+	"""
+	Returns the figure for plotting the xz plane (top view). The figure is reused for all frames,
+	only the position of the ego car is updated and the bounding boxes are replaced.
+
+	Returns:
+		tuple (figure, axes, center line, ego car rectangle)
+	"""
+	global _xz_plot
+
+	if _xz_plot is None:
+		fig, ax = plt.subplots()
+		line, = ax.plot([0, 0], [-10, 150], color='#CCCCCC', linewidth=4, zorder=0)
+		rect = patches.Rectangle((-1.25, -2.5), 2.5, 5, linewidth=1, edgecolor='#000000', 
+								 facecolor='#000000')
+		ax.add_patch(rect)
+
+		ax.axis('equal')
+		ax.axis((-40, 40, -5, 75))
+		fig.subplots_adjust(left=0.0, right=1.0, top=1.0, bottom=0.0)
+
+		_xz_plot = (fig, ax, line, rect)
+
+	return _xz_plot
+
+
+def _plot_bboxes(image, bbs, pgp, corners, colors_hex, colors_bgr, xz_format, scale):
+	"""
+	Plots bounding boxes into the image. If pgp is provided, 3D bounding boxes are plotted into the
+	image and the xz plane (top view) is plotted with matplotlib (unless xz_format is None).
+
+	Input:
+		image:              np.array (cv2.imread read) image
+		bbs:                List of BB2D or BB3D objects to be displayed in this image
+		pgp:                PGP object of this image or None to plot 2D bounding boxes
+		corners:            Tuple (X_3xn, x_2xn) of the 3D and image coordinates of the 3D
+		                    bounding box corners returned by a previous call or None
+		colors_hex:         Dictionary of hex colors of the bounding boxes indexed by labels
+		colors_bgr:         Dictionary of BGR colors of the bounding boxes indexed by labels
+		xz_format:          Format of the xz plane plot ('png', 'pdf', ...) or None - no plot
+		scale:              Downscaling factor of the image with respect to the detections
+	Returns:
+		corners tuple (X_3xn, x_2xn) of the 3D bounding boxes (None for 2D bounding boxes) so they
+		do not have to be reconstructed next time
+	"""
+	if pgp is not None:
+		# Plot 3D bounding boxes
+		if xz_format is not None:
+			fig, ax, line, rect = _get_xz_plot()
+
+			# Remove the bounding boxes of the previous frame
+			for collection in list(ax.collections):
+				collection.remove()
+
+			line.set_xdata([pgp.C_3x1[0,0], pgp.C_3x1[0,0]])
+			rect.set_xy((pgp.C_3x1[0,0]-1.25, pgp.C_3x1[2,0]-2.5))
+
+		if len(bbs) == 0: return None
+
+		if corners is None:
+			# Get all 4 bounding box corners in 3D (FBL FBR RBR RBL FTL FTR RTR RTL) - 8 columns per
+			# bounding box
+			X_3xn = np.hstack([pgp.reconstruct_bb3d(bb) for bb in bbs])
+			# Project them back to image - all bounding boxes at once
+			x_2xn = pgp.project_X_to_x(X_3xn)
+			corners = (X_3xn, x_2xn)
+
+		X_3xn, x_2xn = corners
+
+		# Image coordinates (Kx8x2) and coordinates on the xz plane (Kx8x2) of the corners
+		pts_all = np.rint(np.asarray(x_2xn).T / scale).astype(np.int32).reshape(-1, 8, 2)
+		xz_all  = np.asarray(X_3xn[[0,2],:]).T.reshape(-1, 8, 2)
+
+		# Edges of all bounding boxes on the xz plane - plotted at once
+		segs = xz_all[:,XZ_IDX].reshape(-1, 2, 2)
+		cols = []
+
+		# Endpoints of all edges of all bounding boxes in the image (Kx12x2x2) - gathered at once
+		edges_all = pts_all[:,EDGES_IDX]
+
+		for k, bb in enumerate(bbs):
+			color     = colors_bgr[bb.label]
+			color_hex = colors_hex[bb.label]
+
+			cols.extend(['#00FF00', color_hex, color_hex, '#FF0000'])
+
+			edges = edges_all[k]
+
+			# Plot front side
+			cv2.polylines(image, list(edges[0:4]), False, (0,255,0), 2)
+			# Plot rear side
+			cv2.polylines(image, list(edges[4:8]), False, (0,0,255), 2)
+			# Plot connections
+			cv2.polylines(image, list(edges[8:12]), False, color, 2)
+
+			# txt = detections_mapping[bb.label] + ' %.3f'%(bb.confidence)
+			# cv2.putText(image, txt, (pts_all[k,0,0], pts_all[k,4,1]-5), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, color)
+
+		if xz_format is not None:
+			# In PDF the lines are embedded as one image instead of thousands of vector segments
+			ax.add_collection(LineCollection(segs, colors=cols, linewidths=2, capstyle='projecting',
+											 rasterized=(xz_format == 'pdf')))
+
+		return corners
+
+	else:
+		# Plot 2D bounding boxes
+		# Round the coordinates of all bounding boxes at once
+		xyxy_all = np.rint(np.array([[bb.xmin, bb.ymin, bb.xmax, bb.ymax] for bb in bbs]) / scale)
+		xyxy_all = xyxy_all.astype(np.int32).tolist()
+
+		for bb, xyxy in zip(bbs, xyxy_all):
+			color = colors_bgr[bb.label]
+			cv2.rectangle(image, (xyxy[0], xyxy[1]), (xyxy[2], xyxy[3]), color, 2)
+
+			# txt = detections_mapping[bb.label] + ' %.3f'%(bb.confidence)
+			# cv2.putText(image, txt, (xyxy[0], xyxy[1]-5), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, color)
+
+		return None
+
+
+def _crop_to_bbs(image, bbs, corners, scale):
+	"""
+	Crops the image to the union of the bounding boxes (plus CROP_MARGIN).
+
+	Input:
+		image:   np.array (cv2.imread read) image
+		bbs:     List of BB2D or BB3D objects displayed in this image
+		corners: Tuple (X_3xn, x_2xn) of the 3D bounding box corners or None for 2D bounding boxes
+		scale:   Downscaling factor of the image with respect to the detections
+	Returns:
+		np.array view of the cropped image (the whole image if there is nothing to crop to)
+	"""
+	if len(bbs) == 0: return image
+
+	if corners is not None:
+		x_2xn = np.asarray(corners[1]) / scale
+		xmin, ymin = x_2xn.min(axis=1)
+		xmax, ymax = x_2xn.max(axis=1)
+	else:
+		xyxy_all = np.array([[bb.xmin, bb.ymin, bb.xmax, bb.ymax] for bb in bbs]) / scale
+		xmin, ymin = xyxy_all[:,0:2].min(axis=0)
+		xmax, ymax = xyxy_all[:,2:4].max(axis=0)
+
+	height, width = image.shape[0:2]
+	xmin = int(max(0, np.floor(xmin) - CROP_MARGIN))
+	ymin = int(max(0, np.floor(ymin) - CROP_MARGIN))
+	xmax = int(min(width, np.ceil(xmax) + CROP_MARGIN + 1))
+	ymax = int(min(height, np.ceil(ymax) + CROP_MARGIN + 1))
+
+	# The bounding boxes are outside of the image
+	if xmax <= xmin or ymax <= ymin: return image
+
+	return image[ymin:ymax,xmin:xmax]
+
+
+def _init_worker():
+	"""
+	Initializes a rendering worker process.
+	"""
+	matplotlib.use('Agg')  # Prevents from using X interface for plotting
+
+
+def _load_image(task):
+	"""
+	Reads the image of the given frame.
+
+	Input:
+		task: FrameTask describing the frame
+	Returns:
+		np.array (cv2.imread read) image
+	"""
+	return cv2.imread(get_path_to_image(task.filename, task.path_datasets), 
+					  get_imread_flag(task.scale))
+
+
+def _plot_frame(task, image):
+	"""
+	Plots bounding boxes into the image of the given frame and saves the xz plane plot (if any).
+
+	Input:
+		task:  FrameTask describing the frame
+		image: np.array (cv2.imread read) image of the frame
+	Returns:
+		path to the output image, the output image (not written yet) and the corners of the 3D
+		bounding boxes (see _plot_bboxes())
+	"""
+	print('Processing frame ' + str(task.i))
+
+	# Plot the bounding boxes into the image
+	corners = _plot_bboxes(image, task.bbs, task.pgp, task.corners, task.colors_hex, 
+						   task.colors_bgr, task.xz_format, task.scale)
+
+	filename_out = os.path.join(task.path_out, os.path.basename(task.filename))
+	if task.pgp is not None and task.xz_format is not None:
+		fig = _get_xz_plot()[0]
+		fig.savefig(os.path.splitext(filename_out)[0] + '_xz.' + task.xz_format, dpi=100, 
+					bbox_inches='tight')
+
+	if task.crop_to_bbs:
+		image = _crop_to_bbs(image, task.bbs, corners, task.scale)
+
+	return filename_out, image, corners
+
+
+def _render_one(task):
+	"""
+	Plots bounding boxes into one frame and writes the output image(s). It is a module level
+	function so that it can be sent to the multiprocessing.Pool workers.
+
+	Input:
+		task: FrameTask describing the frame
+	Returns:
+		filename and the corners of the 3D bounding boxes in this image (see _plot_bboxes())
+	"""
+	image = _load_image(task)
+	filename_out, image, corners = _plot_frame(task, image)
+
+	# Write the image
+	cv2.imwrite(filename_out, image)
+
+	return task.filename, corners
+
+
 ####################################################################################################
 #                                             CLASSES                                              # 
 ####################################################################################################
@@ -77,7 +354,8 @@ class ImageGenerator(object):
 	"""
 	"""
 	def __init__(self, path_detections, detections_mapping, confidence, offset=0, 
-				 length=99999999, path_datasets=None, path_pgp=None):
+				 length=99999999, path_datasets=None, path_pgp=None, workers=1, xz_format='png', 
+				 scale=1, crop_to_bbs=False):
 		"""
 		Input:
 			path_detections:    Path to the BBTXT or BB3TXT file with detections
@@ -89,17 +367,30 @@ class ImageGenerator(object):
 								that is in the BBTXT (BB3TXT) files if provided
 			path_pgp:           Path to the PGP file with image projection matrices and ground plane
 			                    equations
+			workers:            Number of processes rendering the images in parallel
+			xz_format:          Format of the xz plane (top view) plots saved with 3D bounding
+			                    boxes, None to skip them
+			scale:              Downscaling factor of the output images (1, 2, 4 or 8)
+			crop_to_bbs:        Crop the output images to the displayed bounding boxes
 		"""
 		super(ImageGenerator, self).__init__()
 		
-		self.confidence    = confidence
 		self.offset        = offset
 		self.max_length    = length
 		self.path_datasets = path_datasets
 		self.path_pgp      = path_pgp
+		self.workers       = max(1, workers)
+		self.xz_format     = xz_format
+		self.scale         = scale
+		self.crop_to_bbs   = crop_to_bbs
 
 		self.detections_mapping = LMM.get_mapping(detections_mapping)
 
+		# Colors of the bounding boxes indexed directly by the labels
+		self._hex = {label: COLORS[category] for label, category in self.detections_mapping.items()
+					 if category in COLORS}
+		self._bgr = {label: HEX2BGR[color] for label, color in self._hex.items()}
+
 
 		print('-- Loading detections: ' + path_detections)
 		if path_pgp is not None:
@@ -110,120 +401,114 @@ class ImageGenerator(object):
 			self.iml_detections = load_bbtxt(path_detections)
 			self.pgps = None
 
+		# Keep only the detections, which will be displayed
+		self.iml_detections = {filename: [bb for bb in bbs if bb.confidence >= confidence] 
+							   for filename, bbs in self.iml_detections.items()}
+
 		self._create_sorted_sequence()
 
+		# Corners of the 3D bounding boxes indexed by filenames - computed during rendering and
+		# reused in the following generate_images() calls
+		self._corners = {}
+
 
 	def _create_sorted_sequence(self):
 		"""
 		Creates a sorted list of files, which we will be cycling through.
 		"""
-		self.file_sequence = self.iml_detections.keys()
-		self.file_sequence.sort()
+		self.file_sequence = sorted(self.iml_detections.keys())
 
 
-	def _plot_bboxes(self, image, filename):
+	def _render_pipelined(self, tasks):
 		"""
-		Plots bounding boxes into the image.
+		Renders the frames in this process, but overlaps reading and writing of the images with
+		plotting. Images are read and written by thread pools (OpenCV releases the GIL), the
+		bounding boxes are plotted in the main thread because matplotlib is not thread safe.
 
 		Input:
-			image: np.array (cv2.imread read) image
-			filename: Path to the image
+			tasks: List of FrameTask tuples describing the frames
 		"""
-		bbs = self.iml_detections[filename]
-
-		if self.pgps is not None:
-			# Plot 3D bounding boxes
-			if filename not in self.pgps.keys():
-				print('ERROR: Missing PGP for file "' + filename + '"!')
-				exit(2)
-
-			plt.cla()
-
-			pgp = self.pgps[filename]
-
-			plt.plot([pgp.C_3x1[0,0], pgp.C_3x1[0,0]], [-10, 150], color='#CCCCCC', linewidth=4, zorder=0)
-			rect = patches.Rectangle((pgp.C_3x1[0,0]-1.25, pgp.C_3x1[2,0]-2.5), 2.5, 5, linewidth=1, 
-									 edgecolor='#000000', facecolor='#000000')
-			ax = plt.gca()
-			ax.add_patch(rect)
-
-			for bb in bbs:
-				if bb.confidence >= self.confidence:
-					# Get all 4 bounding box corners in 3D (FBL FBR RBR RBL FTL FTR RTR RTL)
-					X_3x8 = pgp.reconstruct_bb3d(bb)
-					# Project them back to image
-					x_2x8 = pgp.project_X_to_x(X_3x8)
-
-					color = hex2bgr(COLORS[self.detections_mapping[bb.label]])
-
-					# Draw bb on the xz plane
-					plt.plot([X_3x8[0,0], X_3x8[0,1]], [X_3x8[2,0], X_3x8[2,1]], color='#00FF00', linewidth=2)
-					plt.plot([X_3x8[0,0], X_3x8[0,3]], [X_3x8[2,0], X_3x8[2,3]], color=COLORS[self.detections_mapping[bb.label]], linewidth=2)
-					plt.plot([X_3x8[0,1], X_3x8[0,2]], [X_3x8[2,1], X_3x8[2,2]], color=COLORS[self.detections_mapping[bb.label]], linewidth=2)
-					plt.plot([X_3x8[0,2], X_3x8[0,3]], [X_3x8[2,2], X_3x8[2,3]], color='#FF0000', linewidth=2)
-
-					# Plot front side
-					cv2.line(image, (ri(x_2x8[0,4]), ri(x_2x8[1,4])), (ri(x_2x8[0,5]), ri(x_2x8[1,5])), (0,255,0), 2)
-					cv2.line(image, (ri(x_2x8[0,5]), ri(x_2x8[1,5])), (ri(x_2x8[0,1]), ri(x_2x8[1,1])), (0,255,0), 2)
-					cv2.line(image, (ri(x_2x8[0,0]), ri(x_2x8[1,0])), (ri(x_2x8[0,1]), ri(x_2x8[1,1])), (0,255,0), 2)
-					cv2.line(image, (ri(x_2x8[0,0]), ri(x_2x8[1,0])), (ri(x_2x8[0,4]), ri(x_2x8[1,4])), (0,255,0), 2)
-					# Plot rear side
-					cv2.line(image, (ri(x_2x8[0,2]), ri(x_2x8[1,2])), (ri(x_2x8[0,3]), ri(x_2x8[1,3])), (0,0,255), 2)
-					cv2.line(image, (ri(x_2x8[0,7]), ri(x_2x8[1,7])), (ri(x_2x8[0,3]), ri(x_2x8[1,3])), (0,0,255), 2)
-					cv2.line(image, (ri(x_2x8[0,7]), ri(x_2x8[1,7])), (ri(x_2x8[0,6]), ri(x_2x8[1,6])), (0,0,255), 2)
-					cv2.line(image, (ri(x_2x8[0,6]), ri(x_2x8[1,6])), (ri(x_2x8[0,2]), ri(x_2x8[1,2])), (0,0,255), 2)
-					# Plot connections
-					cv2.line(image, (ri(x_2x8[0,4]), ri(x_2x8[1,4])), (ri(x_2x8[0,7]), ri(x_2x8[1,7])), color, 2)
-					cv2.line(image, (ri(x_2x8[0,5]), ri(x_2x8[1,5])), (ri(x_2x8[0,6]), ri(x_2x8[1,6])), color, 2)
-					cv2.line(image, (ri(x_2x8[0,1]), ri(x_2x8[1,1])), (ri(x_2x8[0,2]), ri(x_2x8[1,2])), color, 2)
-					cv2.line(image, (ri(x_2x8[0,0]), ri(x_2x8[1,0])), (ri(x_2x8[0,3]), ri(x_2x8[1,3])), color, 2)
-
-					# txt = self.detections_mapping[bb.label] + ' %.3f'%(bb.confidence)
-					# cv2.putText(image, txt, (ri(bb.fblx), ri(bb.ftly-5)), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, color)
+		# Maximum number of frames waiting to be plotted or written - bounds the used memory
+		queue_size = 2 * multiprocessing.cpu_count()
 
-		else:
-			# Plot 2D bounding boxes
-			for bb in bbs:
-				if bb.confidence >= self.confidence:
-					color = hex2bgr(COLORS[self.detections_mapping[bb.label]])
-					cv2.rectangle(image, (ri(bb.xmin), ri(bb.ymin)), (ri(bb.xmax), ri(bb.ymax)), color, 2)
+		reader = ThreadPool(4)
+		writer = ThreadPool(4)
+
+		reads  = deque()
+		writes = deque()
+		tasks_iter = iter(tasks)
 
-					# txt = self.detections_mapping[bb.label] + ' %.3f'%(bb.confidence)
-					# cv2.putText(image, txt, (ri(bb.xmin), ri(bb.ymin-5)), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1, color)
+		# Start prefetching the first images
+		for task in itertools.islice(tasks_iter, queue_size):
+			reads.append((task, reader.apply_async(_load_image, (task,))))
+
+		while len(reads) > 0:
+			task, result = reads.popleft()
+			for next_task in itertools.islice(tasks_iter, 1):
+				reads.append((next_task, reader.apply_async(_load_image, (next_task,))))
+
+			image = result.get()
+			filename_out, image, self._corners[task.filename] = _plot_frame(task, image)
+
+			writes.append(writer.apply_async(cv2.imwrite, (filename_out, image)))
+			# Do not keep the frame alive until the next one is read - it is released as soon as
+			# it is written
+			del image, result
+			if len(writes) > queue_size:
+				writes.popleft().get()
+
+		while len(writes) > 0:
+			writes.popleft().get()
+
+		reader.close()
+		writer.close()
+		reader.join()
+		writer.join()
 
 
 	def generate_images(self, path_out):
 		"""
 		Generates images with detections from the currently opened BBTXT or BB3TXT file.
 
+		The peak memory taken by the images is roughly workers * 2 * size of a decoded frame when
+		rendering in several processes and 4 * NCPU * size of a decoded frame for one worker (the
+		read and write queues).
+
 		Input:
 			path_out: Path to the output folder
 		"""
 		if not os.path.exists(path_out):
 			os.makedirs(path_out)
 
-		length = 0
-
-		for i in range(len(self.file_sequence)):
-			if i < self.offset: continue
-			if length >= self.max_length: break
-			print('Processing frame ' + str(i))
+		# Each frame is rendered independently, i.e. we can distribute them to several processes
+		tasks = []
 
-			filename = self.file_sequence[i]
-			image = cv2.imread(get_path_to_image(filename, self.path_datasets))
-
-			# Plot the bounding boxes into the image
-			self._plot_bboxes(image, filename)
-
-			# Write the image
-			filename_out = os.path.join(path_out, os.path.basename(filename))
-			cv2.imwrite(filename_out, image)
+		sequence = self.file_sequence[self.offset:self.offset+self.max_length]
+		for i, filename in enumerate(sequence, start=self.offset):
+			pgp = None
 			if self.pgps is not None:
-				plt.axis('equal')
-				plt.axis((-40, 40, -5, 75))
-				plt.subplots_adjust(left=0.0, right=1.0, top=1.0, bottom=0.0)
-				plt.savefig(os.path.splitext(filename_out)[0] + '_xz.pdf', bbox_inches='tight')
-
+				if filename not in self.pgps:
+					print('ERROR: Missing PGP for file "' + filename + '"!')
+					exit(2)
+				pgp = self.pgps[filename]
+
+			tasks.append(FrameTask(i, filename, self.iml_detections[filename], pgp, 
+								   self._corners.get(filename), self._hex, self._bgr, 
+								   self.path_datasets, path_out, self.xz_format, self.scale, 
+								   self.crop_to_bbs))
+
+		if self.workers == 1:
+			self._render_pipelined(tasks)
+		else:
+			# Processes, not threads - matplotlib is not thread safe
+			# The workers are restarted after 64 frames (8 chunks of 8 frames - the pool counts
+			# chunks as tasks) so that their memory does not keep growing
+			pool = multiprocessing.Pool(processes=self.workers, initializer=_init_worker, 
+										maxtasksperchild=8)
+			for filename, corners in pool.imap_unordered(_render_one, tasks, chunksize=8):
+				self._corners[filename] = corners
+			pool.close()
+			pool.join()
 
 
 ####################################################################################################
@@ -272,6 +557,19 @@ def parse_arguments():
 	parser.add_argument('--path_pgp', type=str, default=None,
 						help='Path to the PGP file with image projection matrices and ground ' \
 						'plane equations. This allows showing the whole 3D bounding box')
+	parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count()-1),
+						help='Number of processes rendering the images in parallel. More workers ' \
+						'need more memory - each holds about 2 decoded frames')
+	parser.add_argument('--xz_format', type=str, default='png', choices=['png', 'jpg', 'pdf'],
+						help='Format of the xz plane (top view) plots saved with 3D bounding boxes')
+	parser.add_argument('--no_xz', action='store_true',
+						help='Do not save the xz plane plots, only the images')
+	parser.add_argument('--scale', type=int, default=1, choices=SCALES,
+						help='Downscale the output images by this factor - faster reading of ' \
+						'the images')
+	parser.add_argument('--crop_to_bbs', action='store_true',
+						help='Crop the output images to the displayed bounding boxes - smaller ' \
+						'files and faster writing')
 
 	args = parser.parse_args()
 
@@ -281,6 +579,11 @@ def parse_arguments():
 		parser.print_help()
 		exit(1)
 
+	if get_imread_flag(args.scale) is None:
+		print('ERROR: OpenCV %s cannot read downscaled images, --scale requires OpenCV 3.2 or newer!'
+			  %(cv2.__version__))
+		exit(1)
+
 	return args
 
 
@@ -289,8 +592,11 @@ def main():
 
 	print('-- DETECTIONS TO IMAGES CONVERTER')
 
+	xz_format = None if args.no_xz else args.xz_format
+
 	vg = ImageGenerator(args.path_detections, args.detections_mapping, args.confidence, 
-						args.offset, args.length, args.path_datasets, args.path_pgp)
+						args.offset, args.length, args.path_datasets, args.path_pgp, args.workers,
+						xz_format, args.scale, args.crop_to_bbs)
 	
 	vg.generate_images(args.path_out)
 
@@ -21,14 +21,63 @@ __email__  = 'novakli2@fel.cvut.cz'
 
 
 import argparse
+import bisect
 import os
 import re
+import numpy as np
 
 import matplotlib
 matplotlib.use('Agg')  # Prevents from using X interface for plotting
 from matplotlib import pyplot as plt
 
 
+####################################################################################################
+#                                           DEFINITIONS                                            # 
+####################################################################################################
+
+# Loss value as printed by Caffe
+_VALUE = r'(?:-?nan|[0-9]+(?:\.[0-9]+)?(?:e[-+]?[0-9]+)?)'
+
+# Size of the chunks in which the log file is read
+LOG_CHUNK_SIZE = 1 << 22
+
+# One pattern for all lines we are interested in, the matched named group tells which line it is
+LOG_PATTERN = re.compile(
+	r'Iteration (?P<iter_valid>[0-9]+), Testing net '
+	r'|Test net output .* (?P<name_valid>loss_?x?[0-9]*) = (?P<value_valid>' + _VALUE + r') '
+	r'|Iteration (?P<iter_train>[0-9]+) \(.*iters.*\), loss = '
+	r'|Train net output .* (?P<name_train>loss_?x?[0-9]*) = (?P<value_train>' + _VALUE + r')'
+)
+
+
+####################################################################################################
+#                                            FUNCTIONS                                             # 
+####################################################################################################
+
+def skip_index(iters, skip):
+	"""
+	Finds the index of the last iteration not greater than skip before the first iteration greater
+	than skip, i.e. where the plot starts when skipping the beginning of the training.
+
+	Input:
+		iters: np.array of iteration numbers in the order from the log
+		skip:  Number of skipped iterations
+	Returns:
+		int index (0 if even the first iteration is greater than skip)
+	"""
+	if np.all(iters[1:] >= iters[:-1]):
+		# Sorted iterations - we can use binary search
+		return max(0, bisect.bisect_right(iters, skip) - 1)
+
+	# The iterations are not sorted (e.g. resumed training appended to the same log) - scan them
+	si = 0
+	for i in range(len(iters)):
+		if iters[i] > skip: break
+		si = i
+
+	return si
+
+
 ####################################################################################################
 #                                             CLASSES                                              # 
 ####################################################################################################
@@ -74,44 +123,69 @@ class LearningCurvePlotter(object):
 		print('-- Processing log file "%s"'%(self.path_log))
 
 		with open(self.path_log, 'r') as infile:
-			for line in infile:
-				line = line.rstrip('\n')
-
-				# We need these lines:
-				# ... solver.cpp:331] Iteration 9400, Testing net (#0)
-				# ... solver.cpp:398]     Test net output #0: loss_x2 = 0.00616695 (* 1 = 0.00616695 loss)
-				# ... solver.cpp:398]     Test net output #1: loss_x4 = 0.0352086 (* 1 = 0.0352086 loss)
-				# ... solver.cpp:398]     Test net output #2: loss_x8 = 0.0470959 (* 1 = 0.0470959 loss)
-				# ... solver.cpp:219] Iteration 30 (0.256841 iter/s, 38.9347s/10 iters), loss = 0.0107558
-				# ... solver.cpp:238]     Train net output #0: loss_x2 = 0.00151235 (* 1 = 0.00151235 loss)
-				# ... solver.cpp:238]     Train net output #1: loss_x4 = 0.00295802 (* 1 = 0.00295802 loss)
-				# ... solver.cpp:238]     Train net output #2: loss_x8 = 0.00589734 (* 1 = 0.00589734 loss)
-
-				m = re.match(r'.* Iteration ([0-9]+), Testing net .*', line)
-				if m is not None:
-					self.iters_valid.append(int(m.group(1)))
-					continue
+			# Read the log in large chunks and split them to lines at once - much faster than reading
+			# the log line by line
+			buf = ''
+			while True:
+				chunk = infile.read(LOG_CHUNK_SIZE)
+				if not chunk: break
+
+				lines = (buf + chunk).split('\n')
+				# The last line may be incomplete - wait for the next chunk
+				buf = lines.pop()
+				self._process_lines(lines)
+
+			if buf: self._process_lines([buf])
+
+		# Slices of numpy arrays (used in the plots) are views, not copies. The losses were collected
+		# as strings - parse each series at once
+		self.iters_valid = np.asarray(self.iters_valid)
+		self.iters_train = np.asarray(self.iters_train)
+		for key in self.losses_valid:
+			self.losses_valid[key] = np.array(self.losses_valid[key], dtype=np.float64)
+		for key in self.losses_train:
+			self.losses_train[key] = np.array(self.losses_train[key], dtype=np.float64)
 
-				m = re.match(r'.* Test net output .* (loss_?x?[0-9]*) = ([0-9]+(\.[0-9]+)?|nan|-nan) .*', line)
-				if m is not None:
-					loss_name = m.group(1)
-					if loss_name not in self.losses_valid.keys(): self.losses_valid[loss_name] = []
-					self.losses_valid[loss_name].append(float(m.group(2)))
-					continue
+		print('-- Done processing log')
 
-				m = re.match(r'.* Iteration ([0-9]+) \(.*iters.*\), loss = .*', line)
-				if m is not None:
-					self.iters_train.append(int(m.group(1)))
-					continue
 
-				m = re.match(r'.* Train net output .* (loss\_?x?[0-9]*) = ([0-9]+(\.[0-9]+)?|nan|-nan).*', line)
-				if m is not None:
-					loss_name = m.group(1)
-					if loss_name not in self.losses_train.keys(): self.losses_train[loss_name] = []
-					self.losses_train[loss_name].append(float(m.group(2)))
-					continue
+	def _process_lines(self, lines):
+		"""
+		Extracts the iteration numbers and loss values from the given lines of the log.
 
-		print('-- Done processing log')
+		Input:
+			lines: List of lines (without the newline characters)
+		"""
+		# The loss values are stored as strings and converted in _process_log_file()
+		for line in lines:
+			# We need these lines:
+			# ... solver.cpp:331] Iteration 9400, Testing net (#0)
+			# ... solver.cpp:398]     Test net output #0: loss_x2 = 0.00616695 (* 1 = 0.00616695 loss)
+			# ... solver.cpp:398]     Test net output #1: loss_x4 = 0.0352086 (* 1 = 0.0352086 loss)
+			# ... solver.cpp:398]     Test net output #2: loss_x8 = 0.0470959 (* 1 = 0.0470959 loss)
+			# ... solver.cpp:219] Iteration 30 (0.256841 iter/s, 38.9347s/10 iters), loss = 0.0107558
+			# ... solver.cpp:238]     Train net output #0: loss_x2 = 0.00151235 (* 1 = 0.00151235 loss)
+			# ... solver.cpp:238]     Train net output #1: loss_x4 = 0.00295802 (* 1 = 0.00295802 loss)
+			# ... solver.cpp:238]     Train net output #2: loss_x8 = 0.00589734 (* 1 = 0.00589734 loss)
+
+			# Cheap test first - most of the lines are not interesting
+			if 'Iteration' not in line and 'net output' not in line: continue
+
+			m = LOG_PATTERN.search(line)
+			if m is None: continue
+
+			if m.group('iter_valid') is not None:
+				self.iters_valid.append(int(m.group('iter_valid')))
+			elif m.group('name_valid') is not None:
+				loss_name = m.group('name_valid')
+				if loss_name not in self.losses_valid: self.losses_valid[loss_name] = []
+				self.losses_valid[loss_name].append(m.group('value_valid'))
+			elif m.group('iter_train') is not None:
+				self.iters_train.append(int(m.group('iter_train')))
+			else:
+				loss_name = m.group('name_train')
+				if loss_name not in self.losses_train: self.losses_train[loss_name] = []
+				self.losses_train[loss_name].append(m.group('value_train'))
 
 
 	def plot_and_save(self, path_out, skip, ylimit):
@@ -131,13 +205,8 @@ class LearningCurvePlotter(object):
 
 		# Determine the index of the skipped iterations
 		if skip > 0:
-			for i in range(len(self.iters_train)):
-				if self.iters_train[i] > skip: break
-				si_train = i
-
-			for i in range(len(self.iters_valid)):
-				if self.iters_valid[i] > skip: break
-				si_valid = i
+			si_train = skip_index(self.iters_train, skip)
+			si_valid = skip_index(self.iters_valid, skip)
 
 
 		colors = ['#3399FF', '#FF3300', '#40BF0D', '#FFE300', '#FF33CC', '#000000']
@@ -170,17 +239,23 @@ class LearningCurvePlotter(object):
 				outfile.write(' ' + key + '_train ' + key + '_valid')
 			outfile.write('\n')
 
+			# Index of each training iteration in the training arrays - the first occurrence if the
+			# iteration repeats (resumed training appended to the same log)
+			train_idx = {}
+			for k, it in enumerate(self.iters_train.tolist()):
+				train_idx.setdefault(it, k)
+
 			for i in range(len(self.iters_valid)):
-				try:
-					i_train = self.iters_train.index(self.iters_valid[i])
-					outfile.write('%d'%(self.iters_valid[i]))
-					for key in skeys:
-						outfile.write(' %f %f'%(self.losses_train[key][i_train],
-									            self.losses_valid[key][i]))
-					outfile.write('\n')
-
-				except ValueError:
+				i_train = train_idx.get(self.iters_valid[i])
+				if i_train is None:
 					print('Warning: Iteration "%d" not in training iterations.'%(self.iters_valid[i]))
+					continue
+
+				outfile.write('%d'%(self.iters_valid[i]))
+				for key in skeys:
+					outfile.write(' %f %f'%(self.losses_train[key][i_train],
+								            self.losses_valid[key][i]))
+				outfile.write('\n')
 
 		print('-- Plots saved to: ' + path_out)
 